@@ -1,16 +1,23 @@
-from fastapi import FastAPI, Form, HTTPException, Query, Path, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, Form, HTTPException, Query, Path, BackgroundTasks, Request
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import stat
+import time
 import logging
 import asyncio
-from typing import Optional
+import anyio
+import aiofiles
+from typing import Dict, Optional, Set, Tuple
 import re
-from pathlib import Path as PathLib
+from collections import OrderedDict
 
 # 导入下载函数
-from download import download_audio, download_video
-from utils import sanitize_filename, is_safe_filename, clean_old_files, schedule_file_cleanup
+from download import download_audio, download_video, DOWNLOAD_DIR
+from utils import (
+    sanitize_filename, is_safe_filename, clean_old_files, schedule_file_cleanup,
+    delete_file_later, watch_file_cleanup, INOTIFY_AVAILABLE,
+)
 
 # 配置日志
 logging.basicConfig(
@@ -38,34 +45,222 @@ app.add_middleware(
 # Railway服务器基本URL
 BASE_URL = "https://youtube-downloader-backend-production.up.railway.app"
 
-# 下载目录路径
-DOWNLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "downloads")
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+# 本进程下载生成的文件名白名单，只有其中的文件允许通过 /download/file/ 获取
+downloaded_files: Set[str] = set()
+
+# 文件分块传输大小（1 MiB）
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# Range请求头格式，例如 "bytes=0-1023"、"bytes=1024-"、"bytes=-500"
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# 文件响应的通用响应头
+FILE_RESPONSE_HEADERS = {
+    "Accept-Ranges": "bytes",
+    "Cache-Control": "public, max-age=600",
+}
+
+# 下载文件的保留时间（分钟），到期后删除
+FILE_MAX_AGE_MINUTES = 30
+
+# 同时运行的下载任务上限，避免过多yt-dlp/ffmpeg进程抢占资源
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))
+
+# 后台任务的强引用集合，防止任务在执行过程中被垃圾回收
+BACKGROUND_TASKS: Set[asyncio.Task] = set()
+
+# 下载线程限流器（需在事件循环中创建）
+download_limiter: Optional[anyio.CapacityLimiter] = None
+
+# 最近下载结果缓存：(URL, 格式) -> (文件路径, 下载时间)，按LRU淘汰
+# 有效期需小于文件保留时间（FILE_MAX_AGE_MINUTES）
+RECENT_DOWNLOADS_MAX_SIZE = 1024
+RECENT_DOWNLOADS_TTL_SECONDS = 25 * 60
+recent_downloads: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+
+# 正在进行的下载任务，键为(URL, 格式)，相同请求共享同一个结果
+inflight_downloads: Dict[Tuple[str, str], asyncio.Future] = {}
+
+# 已安排延迟删除的文件路径，避免重复安排
+pending_deletions: Set[str] = set()
+
+def spawn(coro) -> asyncio.Task:
+    """
+    创建后台任务并保存强引用，任务结束后自动移除
+    
+    Args:
+        coro: 要执行的协程
+        
+    Returns:
+        创建的任务
+    """
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+def file_deleted(file_path: str) -> None:
+    """
+    文件到期删除后，将其移出延迟删除集合和下载白名单
+    
+    Args:
+        file_path: 文件路径
+    """
+    pending_deletions.discard(file_path)
+    downloaded_files.discard(os.path.basename(file_path))
 
-# 定时清理任务
-cleanup_task = None
+async def schedule_file_deletion(file_path: str) -> None:
+    """
+    安排在保留时间到期后删除文件，定时清理任务作为兜底；
+    Linux上由inotify清理任务统一安排，此处不再重复安排
+    （声明为async，使BackgroundTasks在事件循环中执行它，而不是放入线程池）
+    
+    Args:
+        file_path: 文件路径
+    """
+    if INOTIFY_AVAILABLE or file_path in pending_deletions:
+        return
+    pending_deletions.add(file_path)
+    task = spawn(delete_file_later(file_path, FILE_MAX_AGE_MINUTES * 60))
+    task.add_done_callback(lambda _: file_deleted(file_path))
 
 @app.on_event("startup")
 async def startup_event():
     """应用启动时执行的事件"""
-    global cleanup_task
-    # 启动定时清理任务
-    cleanup_task = asyncio.create_task(
-        schedule_file_cleanup(DOWNLOAD_DIR, interval_minutes=10, max_age_minutes=30)
-    )
-    logger.info("已启动文件清理定时任务")
+    global download_limiter
+    # 创建下载限流器，限制同时在线程池中执行的下载任务数
+    download_limiter = anyio.CapacityLimiter(MAX_CONCURRENT_DOWNLOADS)
+    # 启动文件清理任务：Linux上使用inotify事件驱动并辅以低频扫描清理遗留的临时文件，否则定时扫描目录
+    if INOTIFY_AVAILABLE:
+        spawn(watch_file_cleanup(DOWNLOAD_DIR, max_age_minutes=FILE_MAX_AGE_MINUTES,
+                                 on_removed=downloaded_files.discard))
+    else:
+        spawn(schedule_file_cleanup(DOWNLOAD_DIR, interval_minutes=10, max_age_minutes=FILE_MAX_AGE_MINUTES,
+                                    on_removed=downloaded_files.discard))
+    logger.info("已启动文件清理任务")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时执行的事件"""
-    global cleanup_task
-    if cleanup_task:
-        cleanup_task.cancel()
+    tasks = list(BACKGROUND_TASKS)
+    if tasks:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info(f"已取消 {len(tasks)} 个后台任务")
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单段Range请求头
+    
+    Args:
+        range_header: Range请求头的值
+        file_size: 文件大小（字节）
+        
+    Returns:
+        (起始字节, 结束字节)，均包含，可能超出文件范围；
+        不是有效的单段字节范围（例如多段范围、结束位置小于起始位置）时返回None，此时应忽略该请求头
+    """
+    match = RANGE_PATTERN.match(range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start_str, end_str = match.groups()
+    
+    if not start_str:
+        # 后缀范围：请求最后N个字节，N为0时范围无效
+        suffix_length = int(end_str)
+        start = max(file_size - suffix_length, 0) if suffix_length else file_size
+        return start, file_size - 1
+    
+    start = int(start_str)
+    if not end_str:
+        return start, file_size - 1
+    # 结束位置小于起始位置时语法无效，按RFC 9110应忽略该请求头并返回完整内容
+    if int(end_str) < start:
+        return None
+    return start, min(int(end_str), file_size - 1)
+
+async def iter_file_range(file_path: str, start: int, end: int, chunk_size: int = FILE_CHUNK_SIZE):
+    """
+    按字节范围异步读取文件内容（异步生成器，不占用线程池）
+    
+    Args:
+        file_path: 文件路径
+        start: 起始字节（包含）
+        end: 结束字节（包含）
+        chunk_size: 每次读取的块大小
+    """
+    async with aiofiles.open(file_path, "rb") as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = await f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+async def run_download(url: str, format: str) -> str:
+    """
+    在线程池中执行下载，相同URL和格式的并发请求只下载一次
+    
+    Args:
+        url: 视频链接
+        format: 下载格式，'mp3'或'mp4'
+        
+    Returns:
+        保存的文件路径
+    """
+    key = (url, format)
+    
+    # 最近下载过且文件仍存在时直接返回，无需再次下载
+    cached = recent_downloads.get(key)
+    if cached is not None:
+        file_path, downloaded_at = cached
+        if time.time() - downloaded_at < RECENT_DOWNLOADS_TTL_SECONDS and os.path.exists(file_path):
+            recent_downloads.move_to_end(key)
+            logger.info(f"使用最近下载的文件: {file_path}")
+            return file_path
+        del recent_downloads[key]
+    
+    # 已有相同的下载在进行，等待其结果（shield防止取消等待时影响共享任务）
+    future = inflight_downloads.get(key)
+    if future is not None:
+        logger.info(f"复用正在进行的下载任务: {url} ({format})")
         try:
-            await cleanup_task
+            return await asyncio.shield(future)
         except asyncio.CancelledError:
-            pass
-        logger.info("已取消文件清理定时任务")
+            # 只有共享任务本身被取消（发起下载的请求被取消）时才重新发起下载，本请求被取消时照常抛出
+            if not future.cancelled():
+                raise
+            logger.info(f"共享的下载任务已取消，重新下载: {url} ({format})")
+            return await run_download(url, format)
+    
+    # 事件循环是单线程的，这里的检查与登记之间没有await，不需要额外加锁
+    future = asyncio.get_running_loop().create_future()
+    inflight_downloads[key] = future
+    try:
+        # 根据格式选择下载函数，并在线程池中执行，避免阻塞事件循环
+        download_func = download_audio if format == "mp3" else download_video
+        file_path = await anyio.to_thread.run_sync(download_func, url, limiter=download_limiter)
+        future.set_result(file_path)
+        
+        # 记录到最近下载缓存，超出容量时淘汰最久未使用的记录
+        recent_downloads[key] = (file_path, time.time())
+        recent_downloads.move_to_end(key)
+        while len(recent_downloads) > RECENT_DOWNLOADS_MAX_SIZE:
+            recent_downloads.popitem(last=False)
+        return file_path
+    except Exception as e:
+        future.set_exception(e)
+        # 标记异常已读取，没有其他等待者时也不会输出警告
+        future.exception()
+        raise
+    except BaseException:
+        future.cancel()
+        raise
+    finally:
+        inflight_downloads.pop(key, None)
 
 @app.get("/")
 async def read_root():
@@ -79,11 +274,17 @@ async def read_root():
     }
 
 @app.post("/download/")
-async def download_content(url: str = Form(...), format: str = Form(...), mode: str = Query("direct")):
+async def download_content(
+    background_tasks: BackgroundTasks,
+    url: str = Form(...),
+    format: str = Form(...),
+    mode: str = Query("direct"),
+):
     """
     下载视频或音频
     
     Args:
+        background_tasks: 响应发送后执行的后台任务
         url: 视频链接
         format: 下载格式，'mp3'或'mp4'
         mode: 响应模式，'direct'直接返回文件，'json'返回JSON对象
@@ -105,14 +306,14 @@ async def download_content(url: str = Form(...), format: str = Form(...), mode:
         )
     
     try:
-        # 根据格式选择下载函数
-        if format == "mp3":
-            file_path = download_audio(url)
-        else:  # mp4
-            file_path = download_video(url)
+        file_path = await run_download(url, format)
         
-        # 获取文件名
+        # 获取文件名并加入白名单
         filename = os.path.basename(file_path)
+        downloaded_files.add(filename)
+        
+        # 响应发送后安排到期删除该文件
+        background_tasks.add_task(schedule_file_deletion, file_path)
         
         # 根据模式返回不同响应
         if mode == "json":
@@ -145,11 +346,12 @@ async def download_content(url: str = Form(...), format: str = Form(...), mode:
         )
 
 @app.get("/download/file/{filename}")
-async def get_file(filename: str = Path(..., title="文件名")):
+async def get_file(request: Request, filename: str = Path(..., title="文件名")):
     """
-    获取已下载的文件
+    获取已下载的文件，支持Range请求以便断点续传和拖动播放
     
     Args:
+        request: 请求对象
         filename: 文件名
         
     Returns:
@@ -159,21 +361,63 @@ async def get_file(filename: str = Path(..., title="文件名")):
     if not is_safe_filename(filename):
         raise HTTPException(status_code=400, detail="无效的文件名")
     
-    # 使用Path对象确保路径安全
-    file_path_obj = PathLib(DOWNLOAD_DIR) / filename
+    # 只允许获取本服务下载生成的文件
+    if filename not in downloaded_files:
+        raise HTTPException(status_code=404, detail="文件不存在")
     
-    # 检查文件是否在downloads目录下
-    if not str(file_path_obj.resolve()).startswith(str(PathLib(DOWNLOAD_DIR).resolve())):
+    # 规范化路径后，文件的父目录必须正好是downloads目录（DOWNLOAD_DIR导入时已规范化）
+    file_path = os.path.realpath(os.path.join(DOWNLOAD_DIR, filename))
+    if os.path.dirname(file_path) != DOWNLOAD_DIR:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    file_path = str(file_path_obj)
-    
-    if not os.path.exists(file_path) or not os.path.isfile(file_path):
+    # 只调用一次stat，结果同时用于存在性检查和响应头
+    try:
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
+        # 文件已被清理，从白名单中移除
+        downloaded_files.discard(filename)
         raise HTTPException(status_code=404, detail="文件不存在")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    
+    # 处理Range请求，返回206部分内容
+    range_header = request.headers.get("range")
+    byte_range = parse_range_header(range_header, stat_result.st_size) if range_header else None
+    if byte_range is not None:
+        file_size = stat_result.st_size
+        start, end = byte_range
+        if start > end or start >= file_size:
+            raise HTTPException(
+                status_code=416,
+                detail="请求的范围无效",
+                headers={"Content-Range": f"bytes */{file_size}"}
+            )
+        
+        headers = dict(FILE_RESPONSE_HEADERS)
+        headers.update({
+            "Content-Range": f"bytes {start}-{end}/{file_size}",
+            "Content-Length": str(end - start + 1),
+            "Content-Disposition": f'attachment; filename="{filename}"',
+        })
+        return StreamingResponse(
+            iter_file_range(file_path, start, end),
+            status_code=206,
+            headers=headers,
+            media_type='application/octet-stream'
+        )
+    
+    if range_header:
+        # 被忽略的Range请求头（多段范围、语法无效等）需从scope中移除：
+        # 新版Starlette的FileResponse会自行解析Range，否则会返回400或多段206，而不是完整的200响应
+        request.scope["headers"] = [
+            (name, value) for name, value in request.scope["headers"] if name != b"range"
+        ]
     
     return FileResponse(
         path=file_path,
         filename=filename,
+        stat_result=stat_result,
+        headers=FILE_RESPONSE_HEADERS,
         media_type='application/octet-stream'
     )
 
@@ -188,7 +432,9 @@ async def trigger_cleanup(minutes: int = Query(30, title="Minutes", description=
     Returns:
         清理结果
     """
-    deleted = clean_old_files(DOWNLOAD_DIR, max_age_minutes=minutes)
+    # 批量删除在工作线程中执行，不阻塞事件循环
+    deleted = await anyio.to_thread.run_sync(clean_old_files, DOWNLOAD_DIR, minutes)
+    downloaded_files.difference_update(deleted)
     return {
         "success": True,
         "deleted_count": len(deleted),
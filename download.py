@@ -1,27 +1,101 @@
 import yt_dlp
 import os
+import stat
+import asyncio
+import glob
 import shutil
 import time
 import logging
+import threading
 import uuid
-import subprocess
-from typing import Dict, Any, Optional, Callable
-from utils import sanitize_filename, detect_platform
+from typing import Dict, Any, List, Optional, Callable
+from utils import detect_platform
 
 logger = logging.getLogger(__name__)
 
-# 检查ffmpeg是否可用
-def check_ffmpeg() -> bool:
-    """检查系统是否安装了ffmpeg"""
-    import subprocess
-    try:
-        result = subprocess.run(['which', 'ffmpeg'], capture_output=True, text=True)
-        return result.returncode == 0
-    except Exception:
-        return False
+# ffmpeg路径：优先使用FFMPEG_LOCATION环境变量，否则在PATH中查找；路径不存在或不可执行时视为未安装（导入时检测一次，无需启动子进程）
+FFMPEG_BIN = shutil.which(os.getenv("FFMPEG_LOCATION") or 'ffmpeg')
+FFMPEG_AVAILABLE = FFMPEG_BIN is not None
+
+# 下载器选项：并发下载HLS/DASH分片，指定ffmpeg位置；如果安装了aria2c则交给aria2c多连接下载
+DOWNLOADER_OPTS: Dict[str, Any] = {
+    'concurrent_fragment_downloads': 8,
+    # 直接指定ffmpeg位置，yt-dlp无需再次在PATH中查找
+    'ffmpeg_location': FFMPEG_BIN,
+}
+if shutil.which('aria2c'):
+    DOWNLOADER_OPTS.update({
+        'external_downloader': 'aria2c',
+        'external_downloader_args': {'aria2c': ['-x', '16', '-s', '16', '--min-split-size=1M']},
+    })
+
+# ffmpeg后处理参数：提取音频时使用全部CPU核心；合并视频时只复制流不重新编码，
+# 并把moov atom移到文件开头，使浏览器可以边下载边播放
+POSTPROCESSOR_ARGS: Dict[str, Dict[str, List[str]]] = {
+    'mp3': {'extractaudio': ['-threads', '0']},
+    'mp4': {'merger': ['-c', 'copy', '-movflags', '+faststart']},
+}
+
+# 下载目录（导入时规范化并创建一次）
+DOWNLOAD_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), "downloads"))
+os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+# 输出文件名模板：UUID前缀和备用标题通过extract_info的extra_info传入，
+# 使同一组选项可以被多个请求复用；标题由yt-dlp清理（restrictfilenames）
+OUTPUT_TEMPLATE = os.path.join(DOWNLOAD_DIR, "%(file_uuid)s_%(title,fallback_title).200B.%(ext)s")
+
+# 各格式共用的yt-dlp选项
+BASE_YDL_OPTS: Dict[str, Any] = {
+    'outtmpl': OUTPUT_TEMPLATE,
+    'restrictfilenames': True,
+    # 不使用服务器返回的修改时间，保证文件清理按下载时间计算
+    'updatetime': False,
+    'quiet': True,
+    'no_warnings': True,
+    **DOWNLOADER_OPTS,
+}
+
+# 各格式对应的yt-dlp选项
+YDL_OPTS: Dict[str, Dict[str, Any]] = {
+    'mp3': {
+        **BASE_YDL_OPTS,
+        'format': 'bestaudio/best',
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'mp3',
+            'preferredquality': '192',
+        }],
+        'postprocessor_args': POSTPROCESSOR_ARGS['mp3'],
+    },
+    'mp4': {
+        **BASE_YDL_OPTS,
+        'format': 'bestvideo+bestaudio/best',
+        'merge_output_format': 'mp4',
+        'postprocessor_args': POSTPROCESSOR_ARGS['mp4'],
+    },
+}
 
-# 全局变量，保存ffmpeg是否可用
-FFMPEG_AVAILABLE = check_ffmpeg()
+# YoutubeDL实例不是线程安全的，按线程缓存以便在后续请求中复用，
+# 避免每次下载都重新构建提取器列表和加载配置
+_ydl_local = threading.local()
+
+def get_ydl(format_choice: str) -> yt_dlp.YoutubeDL:
+    """
+    获取当前线程复用的YoutubeDL实例
+    
+    Args:
+        format_choice: 下载格式，'mp3'或'mp4'
+        
+    Returns:
+        YoutubeDL实例
+    """
+    instances = getattr(_ydl_local, 'instances', None)
+    if instances is None:
+        instances = _ydl_local.instances = {}
+    ydl = instances.get(format_choice)
+    if ydl is None:
+        ydl = instances[format_choice] = yt_dlp.YoutubeDL(YDL_OPTS[format_choice])
+    return ydl
 
 def download_audio(url: str) -> str:
     """
@@ -39,58 +113,35 @@ def download_audio(url: str) -> str:
     platform = detect_platform(url)
     logger.info(f"检测到平台: {platform}")
     
-    # 创建下载目录
-    download_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "downloads")
-    os.makedirs(download_dir, exist_ok=True)
-    
     try:
-        # 先获取视频信息
-        with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            title = info.get('title', f"{platform} audio")
-            
-        # 清理标题作为文件名
-        safe_title = sanitize_filename(title)
-        logger.info(f"视频标题: {title}")
-        logger.info(f"安全文件名: {safe_title}")
-        
         # 生成随机UUID作为文件名前缀
         file_uuid = str(uuid.uuid4())[:8]
-        output_template = os.path.join(download_dir, f"{file_uuid}_{safe_title}.%(ext)s")
+        extra_info = {'file_uuid': file_uuid, 'fallback_title': f"{platform} audio"}
         
-        # 构建下载命令
-        cmd = [
-            "yt-dlp",
-            "-x",
-            "--audio-format", "mp3",
-            "-o", output_template,
-            url
-        ]
+        # 获取视频信息并下载，只请求一次元数据
+        ydl = get_ydl('mp3')
+        info = ydl.extract_info(url, download=True, extra_info=extra_info)
+        logger.info(f"视频标题: {info.get('title')}")
+        # 后处理会改变扩展名，这里替换为目标格式
+        expected_path = os.path.splitext(ydl.prepare_filename(info))[0] + ".mp3"
         
-        # 执行下载命令
-        logger.info(f"执行命令: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            logger.error(f"下载命令失败: {result.stderr}")
-            raise Exception(f"下载失败: {result.stderr}")
-        
-        # 找到下载的文件
-        expected_path = os.path.join(download_dir, f"{file_uuid}_{safe_title}.mp3")
+        # 优先使用yt-dlp返回的最终文件路径（已包含后处理结果），无需扫描目录
+        requested_downloads = info.get('requested_downloads')
+        if requested_downloads and requested_downloads[0].get('filepath'):
+            expected_path = requested_downloads[0]['filepath']
         
         if os.path.exists(expected_path):
             logger.info(f"文件保存成功：{expected_path}")
             return expected_path
-        else:
-            # 可能文件名不是预期的，查找目录中以UUID开头的文件
-            for filename in os.listdir(download_dir):
-                if filename.startswith(f"{file_uuid}_"):
-                    file_path = os.path.join(download_dir, filename)
-                    logger.info(f"文件保存成功：{file_path}")
-                    return file_path
-            
-            # 如果没有找到文件，抛出异常
-            raise FileNotFoundError(f"下载完成但未找到文件：{expected_path}")
+        
+        # 可能文件名不是预期的，只匹配以UUID开头的文件
+        matches = glob.glob(os.path.join(glob.escape(DOWNLOAD_DIR), f"{file_uuid}_*"))
+        if matches:
+            logger.info(f"文件保存成功：{matches[0]}")
+            return matches[0]
+        
+        # 如果没有找到文件，抛出异常
+        raise FileNotFoundError(f"下载完成但未找到文件：{expected_path}")
     except Exception as e:
         logger.error(f"下载音频时出错: {str(e)}")
         raise
@@ -111,58 +162,35 @@ def download_video(url: str) -> str:
     platform = detect_platform(url)
     logger.info(f"检测到平台: {platform}")
     
-    # 创建下载目录
-    download_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "downloads")
-    os.makedirs(download_dir, exist_ok=True)
-    
     try:
-        # 先获取视频信息
-        with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            title = info.get('title', f"{platform} video")
-            
-        # 清理标题作为文件名
-        safe_title = sanitize_filename(title)
-        logger.info(f"视频标题: {title}")
-        logger.info(f"安全文件名: {safe_title}")
-        
         # 生成随机UUID作为文件名前缀
         file_uuid = str(uuid.uuid4())[:8]
-        output_template = os.path.join(download_dir, f"{file_uuid}_{safe_title}.%(ext)s")
-        
-        # 构建下载命令
-        cmd = [
-            "yt-dlp",
-            "-f", "bestvideo+bestaudio/best",
-            "--merge-output-format", "mp4",
-            "-o", output_template,
-            url
-        ]
+        extra_info = {'file_uuid': file_uuid, 'fallback_title': f"{platform} video"}
         
-        # 执行下载命令
-        logger.info(f"执行命令: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # 获取视频信息并下载，只请求一次元数据
+        ydl = get_ydl('mp4')
+        info = ydl.extract_info(url, download=True, extra_info=extra_info)
+        logger.info(f"视频标题: {info.get('title')}")
+        # 后处理会改变扩展名，这里替换为目标格式
+        expected_path = os.path.splitext(ydl.prepare_filename(info))[0] + ".mp4"
         
-        if result.returncode != 0:
-            logger.error(f"下载命令失败: {result.stderr}")
-            raise Exception(f"下载失败: {result.stderr}")
-        
-        # 找到下载的文件
-        expected_path = os.path.join(download_dir, f"{file_uuid}_{safe_title}.mp4")
+        # 优先使用yt-dlp返回的最终文件路径（已包含后处理结果），无需扫描目录
+        requested_downloads = info.get('requested_downloads')
+        if requested_downloads and requested_downloads[0].get('filepath'):
+            expected_path = requested_downloads[0]['filepath']
         
         if os.path.exists(expected_path):
             logger.info(f"文件保存成功：{expected_path}")
             return expected_path
-        else:
-            # 可能文件名不是预期的，查找目录中以UUID开头的文件
-            for filename in os.listdir(download_dir):
-                if filename.startswith(f"{file_uuid}_"):
-                    file_path = os.path.join(download_dir, filename)
-                    logger.info(f"文件保存成功：{file_path}")
-                    return file_path
-            
-            # 如果没有找到文件，抛出异常
-            raise FileNotFoundError(f"下载完成但未找到文件：{expected_path}")
+        
+        # 可能文件名不是预期的，只匹配以UUID开头的文件
+        matches = glob.glob(os.path.join(glob.escape(DOWNLOAD_DIR), f"{file_uuid}_*"))
+        if matches:
+            logger.info(f"文件保存成功：{matches[0]}")
+            return matches[0]
+        
+        # 如果没有找到文件，抛出异常
+        raise FileNotFoundError(f"下载完成但未找到文件：{expected_path}")
     except Exception as e:
         logger.error(f"下载视频时出错: {str(e)}")
         raise
@@ -188,6 +216,25 @@ class VideoDownloader:
             return self.progress_data[download_id]
         return {"status": "not_found", "message": "Download not found"}
     
+    def clean_old_progress(self, max_age_minutes: int = 60) -> int:
+        """
+        清理已结束（完成或出错）且超过保留时间的进度记录，避免字典无限增长
+        
+        Args:
+            max_age_minutes: 进度记录最大保留时间（分钟）
+            
+        Returns:
+            被清理的记录数量
+        """
+        expire_before = time.time() - max_age_minutes * 60
+        expired = [
+            download_id for download_id, progress in list(self.progress_data.items())
+            if progress.get('completed_at', expire_before) < expire_before
+        ]
+        for download_id in expired:
+            self.progress_data.pop(download_id, None)
+        return len(expired)
+    
     def progress_hook(self, d: Dict[str, Any]) -> None:
         """yt-dlp进度回调函数"""
         download_id = d.get('info_dict', {}).get('__download_id')
@@ -220,6 +267,7 @@ class VideoDownloader:
         elif d['status'] == 'error':
             self.progress_data[download_id].update({
                 'status': 'error',
+                'completed_at': time.time(),
                 'message': d.get('error', '下载出错') if self.progress_data[download_id].get('language') == 'zh' else d.get('error', 'Download error')
             })
     
@@ -234,6 +282,9 @@ class VideoDownloader:
             language: 语言代码，用于提示消息
         """
         try:
+            # 清理过期的进度记录
+            self.clean_old_progress()
+            
             # 初始化进度信息
             self.progress_data[download_id] = {
                 'status': 'starting',
@@ -242,8 +293,8 @@ class VideoDownloader:
                 'language': language
             }
             
-            # 创建临时目录用于此次下载
-            temp_dir = os.path.join(self.download_dir, download_id)
+            # 创建临时目录用于此次下载（位于下载目录内，保证与最终目录在同一文件系统）
+            temp_dir = os.path.join(self.download_dir, '.tmp', download_id)
             os.makedirs(temp_dir, exist_ok=True)
             
             # 配置yt-dlp选项
@@ -253,10 +304,11 @@ class VideoDownloader:
                 'quiet': True,
                 'no_warnings': True,
                 'noplaylist': True,
+                **DOWNLOADER_OPTS,
             }
             
             # 将下载ID添加到info_dict以便在progress_hook中使用
-            ydl_opts['postprocessor_args'] = ['-threads', '4']
+            ydl_opts['postprocessor_args'] = POSTPROCESSOR_ARGS.get(format_choice, {})
             ydl_opts.setdefault('info_dict', {})['__download_id'] = download_id
             
             # 根据格式选择下载选项
@@ -273,6 +325,7 @@ class VideoDownloader:
                 else:
                     self.progress_data[download_id].update({
                         'status': 'error',
+                        'completed_at': time.time(),
                         'message': "FFmpeg not installed. Cannot convert to MP3." if language == "en" else "未安装FFmpeg，无法转换为MP3格式"
                     })
                     return
@@ -284,11 +337,6 @@ class VideoDownloader:
             
             # 开始下载过程
             try:
-                # 先获取视频信息
-                with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    title = info.get('title', 'video')
-                
                 # 下载视频
                 with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                     ydl.download([url])
@@ -299,6 +347,7 @@ class VideoDownloader:
                 if not downloaded_files:
                     self.progress_data[download_id].update({
                         'status': 'error',
+                        'completed_at': time.time(),
                         'message': '下载完成但未找到文件' if language == 'zh' else 'Download completed but no file found'
                     })
                     return
@@ -318,11 +367,18 @@ class VideoDownloader:
                 final_filename = f"{timestamp}_{file_name}{file_ext}"
                 final_file_path = os.path.join(self.download_dir, final_filename)
                 
-                # 移动文件
-                shutil.move(original_file_path, final_file_path)
+                # 通过硬链接把文件放入下载目录（共享inode，不复制数据），再删除临时文件名
+                try:
+                    os.link(original_file_path, final_file_path)
+                    os.unlink(original_file_path)
+                except FileExistsError:
+                    os.replace(original_file_path, final_file_path)
+                except OSError:
+                    # 跨文件系统或不支持硬链接时退回到移动文件
+                    await asyncio.to_thread(shutil.move, original_file_path, final_file_path)
                 
                 # 清理临时目录
-                shutil.rmtree(temp_dir, ignore_errors=True)
+                await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
                 
                 # 获取文件大小
                 file_size = os.path.getsize(final_file_path)
@@ -331,6 +387,7 @@ class VideoDownloader:
                 # 更新进度信息
                 self.progress_data[download_id].update({
                     'status': 'completed',
+                    'completed_at': time.time(),
                     'percent': '100%',
                     'message': '下载完成' if language == 'zh' else 'Download complete',
                     'file': {
@@ -345,32 +402,26 @@ class VideoDownloader:
                 logger.error(f"Error during download: {str(e)}")
                 self.progress_data[download_id].update({
                     'status': 'error',
+                    'completed_at': time.time(),
                     'message': str(e)
                 })
                 # 清理临时目录
                 if os.path.exists(temp_dir):
-                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
         
         except Exception as e:
             logger.error(f"Error in download process: {str(e)}")
             if download_id in self.progress_data:
                 self.progress_data[download_id].update({
                     'status': 'error',
+                    'completed_at': time.time(),
                     'message': str(e)
                 })
     
-    def get_file_info(self, filename: str) -> Optional[Dict[str, str]]:
-        """获取已下载文件的信息"""
-        file_path = os.path.join(self.download_dir, filename)
-        if not os.path.exists(file_path) or not os.path.isfile(file_path):
-            return None
-            
-        file_size = os.path.getsize(file_path)
-        size_mb = file_size / (1024 * 1024)
-        
-        # 获取文件修改时间
-        modified_time = os.path.getmtime(file_path)
-        modified_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(modified_time))
+    def _build_file_info(self, filename: str, file_path: str, stat_result: os.stat_result) -> Dict[str, str]:
+        """根据stat结果构建文件信息"""
+        size_mb = stat_result.st_size / (1024 * 1024)
+        modified_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat_result.st_mtime))
         
         return {
             'name': filename,
@@ -380,19 +431,31 @@ class VideoDownloader:
             'url': f"/api/download/{filename}"
         }
     
+    def get_file_info(self, filename: str) -> Optional[Dict[str, str]]:
+        """获取已下载文件的信息"""
+        file_path = os.path.join(self.download_dir, filename)
+        # 只调用一次stat，同时获取类型、大小和修改时间
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(stat_result.st_mode):
+            return None
+        
+        return self._build_file_info(filename, file_path, stat_result)
+    
     def list_files(self) -> list:
         """列出所有下载的文件"""
         files = []
-        for filename in os.listdir(self.download_dir):
-            file_path = os.path.join(self.download_dir, filename)
-            if os.path.isfile(file_path):
-                file_info = self.get_file_info(filename)
-                if file_info:
-                    files.append(file_info)
+        # scandir在遍历目录时返回文件类型，每个文件只需一次stat
+        with os.scandir(self.download_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    files.append((entry.name, entry.path, entry.stat()))
         
-        # 按修改时间降序排序
-        files.sort(key=lambda x: x['date'], reverse=True)
-        return files
+        # 按修改时间的数值降序排序，排序完成后再格式化显示用的日期
+        files.sort(key=lambda item: item[2].st_mtime, reverse=True)
+        return [self._build_file_info(name, path, stat_result) for name, path, stat_result in files]
     
     def delete_file(self, filename: str) -> bool:
         """删除指定的文件"""
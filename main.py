@@ -1,17 +1,33 @@
-from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any, Union
+from typing import Optional, List, Dict, Any, Set, Union
 import os
-import yt_dlp
+import stat
+import hashlib
 import logging
-import uuid
+import mimetypes
+import aiofiles
+import secrets
 import time
+import asyncio
+import anyio
+import threading
+import functools
+import heapq
+import json
+import sqlite3
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email.utils import formatdate
+from urllib.parse import quote
 import shutil
 
+from utils import is_temp_file
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -39,30 +55,172 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 下载进度跟踪
-download_progress: Dict[str, Dict[str, Any]] = {}
+# 执行yt-dlp下载的线程池，避免阻塞事件循环并限制线程数量
+DOWNLOAD_POOL = ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2, thread_name_prefix="download")
+
+# 同时进行的下载数上限，满载时直接拒绝新的下载请求（限流器在启动时创建）
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))
+DOWNLOAD_RETRY_AFTER_SECONDS = 30
+DL_LIMITER: Optional[anyio.CapacityLimiter] = None
+# 已接受但尚未结束的下载任务（包括还在等待限流器的任务），接受请求时即创建；
+# 同时保存强引用，防止任务在执行过程中被垃圾回收
+download_tasks: Set[asyncio.Task] = set()
+
+# 下载进度跟踪：持久化到SQLite（WAL模式），重启后仍可查询；超出条目上限时淘汰最久未更新的记录，
+# 已结束的记录超过保留时间后清理。数据库可被多个worker进程共享，每条记录标明所属进程
+PROGRESS_DB = os.getenv("PROGRESS_DB") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "progress.db")
+MAX_PROGRESS_ENTRIES = 1024
+PROGRESS_TTL_SECONDS = 3600
+progress_db = sqlite3.connect(PROGRESS_DB, check_same_thread=False, isolation_level=None)
+progress_db.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    CREATE TABLE IF NOT EXISTS progress (id TEXT PRIMARY KEY, json TEXT NOT NULL, status TEXT, ts REAL NOT NULL);
+    CREATE INDEX IF NOT EXISTS progress_ts ON progress (ts);
+""")
+# 旧版本创建的表没有owner列
+if 'owner' not in {column[1] for column in progress_db.execute("PRAGMA table_info(progress)")}:
+    progress_db.execute("ALTER TABLE progress ADD COLUMN owner TEXT")
+# 当前进程的标识：主机名:进程号:启动令牌（进程号可能被重启后的进程复用，例如容器中的1号进程）
+PROGRESS_OWNER = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+# 连接可能被工作线程和事件循环同时使用，访问时需要加锁
+progress_lock = threading.Lock()
+# 进度清理任务
+progress_cleanup_task = None
+
+def write_progress_row(download_id: str, progress: Dict[str, Any]) -> None:
+    """写入一条进度记录（调用方需持有progress_lock）"""
+    progress['updated_at'] = time.time()
+    progress_db.execute(
+        "INSERT OR REPLACE INTO progress (id, json, status, ts, owner) VALUES (?, ?, ?, ?, ?)",
+        (download_id, json.dumps(progress), progress.get('status'), progress['updated_at'], PROGRESS_OWNER)
+    )
+
+def set_progress(download_id: str, progress: Dict[str, Any]) -> None:
+    """写入新的进度记录，超出上限时淘汰最久未更新的记录"""
+    with progress_lock:
+        write_progress_row(download_id, progress)
+        progress_db.execute(
+            "DELETE FROM progress WHERE id IN (SELECT id FROM progress ORDER BY ts DESC LIMIT -1 OFFSET ?)",
+            (MAX_PROGRESS_ENTRIES,)
+        )
+
+def update_progress(download_id: str, changes: Dict[str, Any]) -> None:
+    """更新已有的进度记录，记录已被淘汰时忽略"""
+    with progress_lock:
+        row = progress_db.execute("SELECT json FROM progress WHERE id = ?", (download_id,)).fetchone()
+        if row is None:
+            return
+        progress = json.loads(row[0])
+        progress.update(changes)
+        write_progress_row(download_id, progress)
+
+def read_progress(download_id: str) -> Optional[Dict[str, Any]]:
+    """读取进度记录，不存在时返回None"""
+    with progress_lock:
+        row = progress_db.execute("SELECT json FROM progress WHERE id = ?", (download_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def clean_old_progress() -> int:
+    """清理已结束且超过保留时间的进度记录，返回清理数量"""
+    expire_before = time.time() - PROGRESS_TTL_SECONDS
+    with progress_lock:
+        return progress_db.execute(
+            "DELETE FROM progress WHERE status IN ('completed', 'error') AND ts < ?",
+            (expire_before,)
+        ).rowcount
+
+def owner_is_gone(owner: Optional[str]) -> bool:
+    """判断记录所属的进程是否已经退出；其他主机上的进程无法判断，视为仍在运行"""
+    if not owner:
+        return True
+    host, pid, token = owner.rsplit(':', 2)
+    if host != socket.gethostname():
+        return False
+    if os.name != 'posix':
+        # 只有POSIX上os.kill(pid, 0)是无副作用的存活检查
+        return False
+    if int(pid) == os.getpid():
+        # 进程号相同但启动令牌不同，是复用了进程号的上一个进程
+        return owner != PROGRESS_OWNER
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+def abort_unfinished_progress() -> int:
+    """将已退出进程遗留的未结束下载标记为出错（这些下载已不再进行），其他存活worker的记录不受影响，返回标记数量"""
+    with progress_lock:
+        rows = [
+            (download_id, data) for download_id, data, owner in progress_db.execute(
+                "SELECT id, json, owner FROM progress WHERE status NOT IN ('completed', 'error')"
+            ).fetchall()
+            if owner_is_gone(owner)
+        ]
+        for download_id, data in rows:
+            progress = json.loads(data)
+            progress.update({
+                'status': 'error',
+                'message': '下载已中断' if progress.get('language') == 'zh' else 'Download interrupted'
+            })
+            write_progress_row(download_id, progress)
+    return len(rows)
+
+# yt-dlp线程中产生的进度更新先合并到这里，由事件循环每隔PROGRESS_FLUSH_INTERVAL秒统一写入
+PROGRESS_FLUSH_INTERVAL = 0.1
+pending_progress: Dict[str, Dict[str, Any]] = {}
+progress_flush_handle: Optional[asyncio.TimerHandle] = None
+
+def queue_progress(download_id: str, changes: Dict[str, Any]) -> None:
+    """在事件循环中暂存进度更新，同一下载只保留最新的值"""
+    global progress_flush_handle
+    pending_progress.setdefault(download_id, {}).update(changes)
+    if progress_flush_handle is None:
+        progress_flush_handle = asyncio.get_running_loop().call_later(PROGRESS_FLUSH_INTERVAL, flush_progress)
+
+def flush_progress(download_id: Optional[str] = None) -> None:
+    """将暂存的进度更新写入进度存储，指定download_id时只写入该下载"""
+    global progress_flush_handle
+    if download_id is not None:
+        changes = pending_progress.pop(download_id, None)
+        if changes:
+            update_progress(download_id, changes)
+        return
+    progress_flush_handle = None
+    while pending_progress:
+        pending_id, changes = pending_progress.popitem()
+        update_progress(pending_id, changes)
+
+async def schedule_progress_cleanup(interval_minutes: int = 5):
+    """定时清理过期进度记录"""
+    while True:
+        await asyncio.sleep(interval_minutes * 60)
+        removed = clean_old_progress()
+        if removed:
+            logger.info(f"Removed {removed} expired progress entries")
 
 # 请求模型
 class DownloadRequest(BaseModel):
     url: str
     format: str = "mp4"  # mp4 或 mp3
 
-# 检查ffmpeg是否可用
-def check_ffmpeg():
-    import subprocess
-    try:
-        result = subprocess.run(['which', 'ffmpeg'], capture_output=True, text=True)
-        return result.returncode == 0
-    except Exception:
-        return False
+class BatchDownloadRequest(BaseModel):
+    urls: List[str]
+    format: str = "mp4"  # mp4 或 mp3
 
-FFMPEG_AVAILABLE = check_ffmpeg()
+# HLS/DASH分片的并发下载数
+CONCURRENT_FRAGMENT_DOWNLOADS = 4
 
-# 进度钩子
-def progress_hook(d):
-    download_id = d.get('info_dict', {}).get('__download_id')
-    if not download_id:
-        return
+# ffmpeg路径：优先使用FFMPEG_LOCATION环境变量，否则在PATH中查找；路径不存在或不可执行时视为未安装（导入时检测一次）
+FFMPEG_BIN = shutil.which(os.getenv("FFMPEG_LOCATION") or 'ffmpeg')
+FFMPEG_AVAILABLE = FFMPEG_BIN is not None
+
+# 进度钩子：在yt-dlp线程中调用，只计算变更并交给事件循环合并写入
+def progress_hook(download_id, language, loop, d):
+    changes = None
     
     if d['status'] == 'downloading':
         total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
@@ -70,7 +228,7 @@ def progress_hook(d):
         
         if total_bytes > 0:
             percent = (downloaded_bytes / total_bytes) * 100
-            download_progress[download_id].update({
+            changes = {
                 'status': 'downloading',
                 'percent': f"{percent:.1f}%",
                 'downloaded': downloaded_bytes,
@@ -78,235 +236,393 @@ def progress_hook(d):
                 'speed': d.get('speed', 0),
                 'eta': d.get('eta', 0),
                 'filename': d.get('filename', ''),
-            })
+            }
     
     elif d['status'] == 'finished':
-        download_progress[download_id].update({
+        changes = {
             'status': 'processing',
             'percent': '100%',
-            'message': '处理中...' if download_progress[download_id].get('language') == 'zh' else 'Processing...'
-        })
+            'message': '处理中...' if language == 'zh' else 'Processing...'
+        }
     
     elif d['status'] == 'error':
-        download_progress[download_id].update({
+        changes = {
             'status': 'error',
-            'message': d.get('error', '下载出错') if download_progress[download_id].get('language') == 'zh' else d.get('error', 'Download error')
-        })
+            'message': d.get('error', '下载出错') if language == 'zh' else d.get('error', 'Download error')
+        }
+    
+    if changes:
+        loop.call_soon_threadsafe(queue_progress, download_id, changes)
+
+# 下载目录总大小上限（字节），0表示不限制；超出时从最旧的文件开始删除
+MAX_DOWNLOAD_DIR_BYTES = int(os.getenv("MAX_DOWNLOAD_DIR_BYTES", "0"))
 
 # 清理旧文件（作为后台任务）
-def cleanup_old_files(max_age_hours=24):
+def cleanup_old_files(max_age_hours=24, max_total_bytes=MAX_DOWNLOAD_DIR_BYTES):
     try:
         now = time.time()
         max_age_seconds = max_age_hours * 3600
+        total_bytes = 0
         
-        for filename in os.listdir(DOWNLOAD_DIR):
-            file_path = os.path.join(DOWNLOAD_DIR, filename)
-            if os.path.isfile(file_path):
-                file_age = now - os.path.getmtime(file_path)
+        # 第一遍：删除过期文件，同时统计剩余文件总大小
+        with os.scandir(DOWNLOAD_DIR) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat()
+                file_age = now - st.st_mtime
                 if file_age > max_age_seconds:
-                    os.remove(file_path)
-                    logger.info(f"Removed old file: {filename}")
+                    os.remove(entry.path)
+                    logger.info(f"Removed old file: {entry.name}")
+                else:
+                    total_bytes += st.st_size
+        
+        excess = total_bytes - max_total_bytes
+        if not max_total_bytes or excess <= 0:
+            return
+        
+        # 第二遍：用堆只保留足以抵消超出部分的最旧文件，内存占用与需删除的文件数成正比
+        # 堆顶是堆中最新的文件，去掉它仍能抵消超出部分时就将其移出
+        oldest = []
+        heap_bytes = 0
+        with os.scandir(DOWNLOAD_DIR) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat()
+                heapq.heappush(oldest, (-st.st_mtime, st.st_size, entry.path))
+                heap_bytes += st.st_size
+                while heap_bytes - oldest[0][1] >= excess:
+                    heap_bytes -= heapq.heappop(oldest)[1]
+        
+        for _, _, path in oldest:
+            try:
+                os.remove(path)
+                logger.info(f"Removed file to stay under size limit: {os.path.basename(path)}")
+            except FileNotFoundError:
+                pass
     except Exception as e:
         logger.error(f"Error cleaning up old files: {e}")
 
 @app.on_event("startup")
 async def startup_event():
-    cleanup_old_files()  # 启动时清理旧文件
+    global progress_cleanup_task, DL_LIMITER
+    DL_LIMITER = anyio.CapacityLimiter(MAX_CONCURRENT_DOWNLOADS)
+    # 启动时清理旧文件，在工作线程中执行以免大量unlink阻塞事件循环
+    await asyncio.to_thread(cleanup_old_files)
+    # 清理过期的进度记录，并结束上次运行中被中断的下载
+    clean_old_progress()
+    aborted = abort_unfinished_progress()
+    if aborted:
+        logger.info(f"Marked {aborted} interrupted downloads as failed")
+    # 定时清理过期的进度记录
+    progress_cleanup_task = asyncio.create_task(schedule_progress_cleanup())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if progress_cleanup_task:
+        progress_cleanup_task.cancel()
+    for task in list(download_tasks):
+        task.cancel()
+    DOWNLOAD_POOL.shutdown(wait=False)
 
 @app.get("/")
 async def read_root():
     return {"message": "Video Downloader API is running"}
 
-@app.post("/api/download")
-async def download_video(request: DownloadRequest, background_tasks: BackgroundTasks):
-    url = request.url
-    format_choice = request.format
-    language = "en"  # 默认语言，可以通过请求头获取
+def build_ydl_opts(download_id: str, format_choice: str) -> Dict[str, Any]:
+    # 配置yt-dlp选项，文件直接写入下载目录，以下载ID作为文件名前缀保证唯一；
+    # 文件名中带视频ID，批量下载中标题相同的视频不会被当作已下载而跳过
+    ydl_opts = {
+        'outtmpl': os.path.join(DOWNLOAD_DIR, f'{download_id}_%(title)s_%(id)s.%(ext)s'),
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+        # 直接指定ffmpeg位置，yt-dlp无需再次在PATH中查找
+        'ffmpeg_location': FFMPEG_BIN,
+        # 并发下载分片，分段视频不再逐个分片串行下载
+        'concurrent_fragment_downloads': CONCURRENT_FRAGMENT_DOWNLOADS,
+    }
     
-    if not url:
+    ydl_opts['postprocessor_args'] = ['-threads', '4']
+    
+    # 根据格式选择下载选项
+    if format_choice == 'mp3':
+        ydl_opts.update({
+            'format': 'bestaudio/best',
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'mp3',
+                'preferredquality': '192',
+            }],
+        })
+    else:  # mp4
+        ydl_opts.update({
+            'format': 'bestvideo+bestaudio/best',
+            'merge_output_format': 'mp4',
+        })
+    
+    return ydl_opts
+
+def start_download(urls: List[str], format_choice: str, language: str = "en"):
+    if format_choice == 'mp3' and not FFMPEG_AVAILABLE:
         return JSONResponse(
             status_code=400,
-            content={"success": False, "message": "URL is required"}
+            content={
+                "success": False,
+                "message": "FFmpeg not installed. Cannot convert to MP3."
+            }
+        )
+    
+    # 已接受的下载数达到上限时返回429，让客户端稍后重试；
+    # 只看限流器会漏算尚未取得令牌的任务
+    if len(download_tasks) >= MAX_CONCURRENT_DOWNLOADS:
+        return JSONResponse(
+            status_code=429,
+            content={"success": False, "message": "Too many downloads in progress. Please retry later."},
+            headers={"Retry-After": str(DOWNLOAD_RETRY_AFTER_SECONDS)}
         )
     
     # 生成唯一下载ID
-    download_id = str(uuid.uuid4())
+    download_id = secrets.token_urlsafe(16)
     
     # 初始化进度信息
-    download_progress[download_id] = {
+    set_progress(download_id, {
         'status': 'starting',
         'percent': '0%',
         'message': '准备下载...' if language == 'zh' else 'Preparing download...',
         'language': language
-    }
+    })
     
     try:
-        # 创建临时目录用于此次下载
-        temp_dir = os.path.join(DOWNLOAD_DIR, download_id)
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # 配置yt-dlp选项
-        ydl_opts = {
-            'outtmpl': os.path.join(temp_dir, '%(title)s.%(ext)s'),
-            'progress_hooks': [progress_hook],
-            'quiet': True,
-            'no_warnings': True,
-            'noplaylist': True,
-        }
-        
-        # 将下载ID添加到info_dict以便在progress_hook中使用
-        ydl_opts['postprocessor_args'] = ['-threads', '4']
-        ydl_opts.setdefault('info_dict', {})['__download_id'] = download_id
+        ydl_opts = build_ydl_opts(download_id, format_choice)
         
-        # 根据格式选择下载选项
-        if format_choice == 'mp3':
-            if FFMPEG_AVAILABLE:
-                ydl_opts.update({
-                    'format': 'bestaudio/best',
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    }],
-                })
-            else:
-                return JSONResponse(
-                    status_code=400,
-                    content={
-                        "success": False,
-                        "message": "FFmpeg not installed. Cannot convert to MP3."
-                    }
-                )
-        else:  # mp4
-            ydl_opts.update({
-                'format': 'bestvideo+bestaudio/best',
-                'merge_output_format': 'mp4',
-            })
-        
-        # 后台下载视频
-        background_tasks.add_task(download_in_background, url, ydl_opts, download_id, format_choice)
+        # 接受请求时即创建后台下载任务，任务结束（包括被取消）时自动移出集合，不会因响应发送失败而占用名额
+        task = asyncio.create_task(download_in_background(urls, ydl_opts, download_id))
+        download_tasks.add(task)
+        task.add_done_callback(download_tasks.discard)
         
         return {"success": True, "download_id": download_id}
     
     except Exception as e:
         logger.error(f"Error starting download: {str(e)}")
-        if download_id in download_progress:
-            download_progress[download_id]['status'] = 'error'
-            download_progress[download_id]['message'] = str(e)
+        update_progress(download_id, {
+            'status': 'error',
+            'message': str(e)
+        })
         
         return JSONResponse(
             status_code=500,
             content={"success": False, "message": f"Error: {str(e)}"}
         )
 
-async def download_in_background(url, ydl_opts, download_id, format_choice):
+@app.post("/api/download")
+async def download_video(request: DownloadRequest):
+    url = request.url
+    language = "en"  # 默认语言，可以通过请求头获取
+    
+    if not url:
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "message": "URL is required"}
+        )
+    
+    return start_download([url], request.format, language)
+
+@app.post("/api/download_batch")
+async def download_batch(request: BatchDownloadRequest):
+    # 多个链接共用一个YoutubeDL实例下载，只初始化一次提取器
+    # 去掉空链接和重复链接
+    urls = list(dict.fromkeys(url for url in request.urls if url))
+    language = "en"  # 默认语言，可以通过请求头获取
+    
+    if not urls:
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "message": "At least one URL is required"}
+        )
+    
+    return start_download(urls, request.format, language)
+
+async def download_in_background(urls, ydl_opts, download_id):
+    async with DL_LIMITER:
+        await run_download(urls, ydl_opts, download_id)
+
+async def run_download(urls, ydl_opts, download_id):
+    language = (read_progress(download_id) or {}).get('language')
+    loop = asyncio.get_running_loop()
+    # 每次下载绑定自己的下载ID和事件循环
+    ydl_opts['progress_hooks'] = [functools.partial(progress_hook, download_id, language, loop)]
     try:
-        # 先获取视频信息
-        with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            title = info.get('title', 'video')
+        # 下载视频（在线程池中执行，不阻塞事件循环），所有链接交给同一个YoutubeDL实例，
+        # extract_info(download=True)一次完成信息提取和下载
+        def download():
+            # 延迟导入yt_dlp：加载全部提取器耗时且占内存，只提供文件/进度接口的进程无需加载；
+            # 在线程池中导入，首次导入不会阻塞事件循环
+            import yt_dlp
+            # 逐个链接捕获错误，批量下载中某个链接失败不影响其他链接
+            infos, errors = [], []
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                for url in urls:
+                    try:
+                        infos.append(ydl.extract_info(url, download=True))
+                    except Exception as e:
+                        logger.error(f"Error downloading {url}: {str(e)}")
+                        errors.append({'url': url, 'message': str(e)})
+            return infos, errors
         
-        # 下载视频
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+        infos, errors = await loop.run_in_executor(DOWNLOAD_POOL, download)
+        # 先写入尚未合并的进度，避免其覆盖下面的最终状态
+        flush_progress(download_id)
         
-        # 找到下载的文件
-        temp_dir = os.path.join(DOWNLOAD_DIR, download_id)
-        downloaded_files = os.listdir(temp_dir)
+        # 直接从yt-dlp返回的信息中获取最终文件路径（已包含后处理结果），无需扫描目录
+        downloaded_paths = [
+            requested['filepath']
+            for info in infos if info
+            for requested in info.get('requested_downloads') or []
+            if requested.get('filepath')
+        ]
         
-        if not downloaded_files:
-            download_progress[download_id].update({
+        if not downloaded_paths:
+            if errors:
+                message = '; '.join(error['message'] for error in errors)
+            else:
+                message = '下载完成但未找到文件' if language == 'zh' else 'Download completed but no file found'
+            update_progress(download_id, {
                 'status': 'error',
-                'message': '下载完成但未找到文件' if download_progress[download_id].get('language') == 'zh' else 'Download completed but no file found'
+                'message': message,
+                'errors': errors
             })
             return
         
-        # 移动文件到主下载目录并生成唯一文件名
-        downloaded_file = downloaded_files[0]
-        original_file_path = os.path.join(temp_dir, downloaded_file)
-        
-        # 构建最终文件名（时间戳_标题.扩展名）
-        timestamp = int(time.time())
-        file_name, file_ext = os.path.splitext(downloaded_file)
-        if format_choice == 'mp3' and not file_ext.lower() == '.mp3':
-            file_ext = '.mp3'
-        elif format_choice == 'mp4' and not file_ext.lower() == '.mp4':
-            file_ext = '.mp4'
-        
-        final_filename = f"{timestamp}_{file_name}{file_ext}"
-        final_file_path = os.path.join(DOWNLOAD_DIR, final_filename)
-        
-        # 移动文件
-        shutil.move(original_file_path, final_file_path)
-        
-        # 清理临时目录
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        
-        # 获取文件大小
-        file_size = os.path.getsize(final_file_path)
-        size_mb = file_size / (1024 * 1024)
-        
-        # 更新进度信息
-        download_progress[download_id].update({
-            'status': 'completed',
-            'percent': '100%',
-            'message': '下载完成' if download_progress[download_id].get('language') == 'zh' else 'Download complete',
-            'file': {
+        # 文件已直接保存在下载目录中，无需再移动
+        files = []
+        for final_file_path in downloaded_paths:
+            final_filename = os.path.basename(final_file_path)
+            
+            # 获取文件大小
+            file_size = os.path.getsize(final_file_path)
+            size_mb = file_size / (1024 * 1024)
+            
+            files.append({
                 'name': final_filename,
                 'path': final_file_path,
                 'size': f"{size_mb:.2f} MB",
                 'url': f"/api/download/{final_filename}"
-            }
+            })
+        
+        # 更新进度信息（单个下载时只有一个文件，批量下载时files包含全部成功的文件，errors列出失败的链接）
+        update_progress(download_id, {
+            'status': 'completed',
+            'percent': '100%',
+            'message': '下载完成' if language == 'zh' else 'Download complete',
+            'file': files[0],
+            'files': files,
+            'errors': errors
         })
         
     except Exception as e:
         logger.error(f"Error during download: {str(e)}")
-        download_progress[download_id].update({
+        flush_progress(download_id)
+        update_progress(download_id, {
             'status': 'error',
             'message': str(e)
         })
 
 @app.get("/api/progress/{download_id}")
 async def get_progress(download_id: str):
-    if download_id in download_progress:
-        return download_progress[download_id]
+    progress = read_progress(download_id)
+    if progress is not None:
+        return progress
     return {"status": "not_found", "message": "Download not found"}
 
+# 文件流式发送的块大小
+FILE_CHUNK_SIZE = 1024 * 1024
+# posix_fadvise仅在POSIX系统上可用
+FADVISE_AVAILABLE = hasattr(os, 'posix_fadvise')
+
+async def iter_file(file_path: str, chunk_size: int = FILE_CHUNK_SIZE):
+    """顺序读取整个文件，完整发送后不再保留其页缓存"""
+    async with aiofiles.open(file_path, "rb") as f:
+        fd = f.fileno()
+        # 提示内核顺序读取以加大预读，保持磁盘队列饱和
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            data = await f.read(chunk_size)
+            if not data:
+                break
+            yield data
+        # 只在完整发送后丢弃页缓存，中途断开的客户端很可能马上续传；
+        # 文件名带有下载ID，每个文件通常只有发起下载的客户端读取
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
 @app.get("/api/download/{filename}")
-async def download_file(filename: str):
+async def download_file(filename: str, request: Request):
+    # 下载中的临时文件（.part、.ytdl等）与成品位于同一目录，不对外提供
+    if is_temp_file(filename):
+        raise HTTPException(status_code=404, detail="File not found")
+    
     file_path = os.path.join(DOWNLOAD_DIR, filename)
-    if not os.path.exists(file_path):
+    try:
+        st = os.stat(file_path)
+    except (OSError, ValueError):
+        # 文件不存在、文件名无效（例如包含空字符）等情况
         raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(st.st_mode):
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    # 完整下载时自行流式发送，以便提示预读并在发送后释放页缓存；Range请求仍交给FileResponse处理
+    if FADVISE_AVAILABLE and 'range' not in request.headers:
+        quoted_filename = quote(filename)
+        if quoted_filename != filename:
+            content_disposition = f"attachment; filename*=utf-8''{quoted_filename}"
+        else:
+            content_disposition = f'attachment; filename="{filename}"'
+        # 与FileResponse相同的ETag和Last-Modified，客户端可据此发送If-Range或重新验证
+        etag = hashlib.md5(f"{st.st_mtime}-{st.st_size}".encode(), usedforsecurity=False).hexdigest()
+        return StreamingResponse(
+            iter_file(file_path),
+            media_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            headers={
+                'Accept-Ranges': 'bytes',
+                'Content-Length': str(st.st_size),
+                'Content-Disposition': content_disposition,
+                'ETag': f'"{etag}"',
+                'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+            }
+        )
     
+    # 不指定media_type，由Starlette根据扩展名推断（video/mp4、audio/mpeg），并声明支持Range请求
     return FileResponse(
         path=file_path, 
         filename=filename,
-        media_type='application/octet-stream'
+        stat_result=st,
+        headers={'Accept-Ranges': 'bytes'}
     )
 
 @app.get("/api/files")
 async def list_files():
-    files = []
-    for filename in os.listdir(DOWNLOAD_DIR):
-        if os.path.isfile(os.path.join(DOWNLOAD_DIR, filename)):
-            file_path = os.path.join(DOWNLOAD_DIR, filename)
-            file_size = os.path.getsize(file_path)
-            size_mb = file_size / (1024 * 1024)
-            
-            # 获取文件修改时间
-            modified_time = os.path.getmtime(file_path)
-            modified_date = datetime.fromtimestamp(modified_time).strftime('%Y-%m-%d %H:%M:%S')
-            
-            files.append({
-                'name': filename,
-                'size': f"{size_mb:.2f} MB",
-                'date': modified_date,
-                'url': f"/api/download/{filename}"
-            })
+    entries_info = []
+    # scandir遍历目录时已带回文件类型，每个文件只需一次stat
+    with os.scandir(DOWNLOAD_DIR) as entries:
+        for entry in entries:
+            # 跳过下载中的临时文件
+            if not entry.is_file(follow_symlinks=False) or is_temp_file(entry.name):
+                continue
+            st = entry.stat()
+            entries_info.append((st.st_mtime, entry.name, st.st_size))
     
-    # 按修改时间降序排序
-    files.sort(key=lambda x: x['date'], reverse=True)
-    return files
+    # 按修改时间降序排序，直接比较数值时间戳，排序后再格式化
+    entries_info.sort(key=lambda x: x[0], reverse=True)
+    return [
+        {
+            'name': name,
+            'size': f"{size / (1024 * 1024):.2f} MB",
+            'date': datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S'),
+            'url': f"/api/download/{name}"
+        }
+        for mtime, name, size in entries_info
+    ]
 
 @app.delete("/api/files/{filename}")
 async def delete_file(filename: str):
@@ -1,13 +1,56 @@
 import os
+import re
 import time
 import logging
 import shutil
 import asyncio
+import functools
 from datetime import datetime
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional
 
 logger = logging.getLogger(__name__)
 
+# inotify仅在Linux上可用，其他平台退回到定时轮询清理
+try:
+    from asyncinotify import Inotify, Mask
+    INOTIFY_AVAILABLE = True
+except ImportError:
+    INOTIFY_AVAILABLE = False
+
+# 安全文件名：1-255个字母、数字、下划线、连字符或点，不以点开头，且不是Windows保留设备名
+# 白名单字符集天然排除了路径分隔符、空字符和控制字符，一次匹配即可完成全部检查
+_SAFE_FILENAME = re.compile(
+    r'(?!\.)(?!(?:CON|PRN|AUX|NUL|COM[1-9]|LPT[1-9])(?:\.|$))[\w.\-]{1,255}',
+    re.ASCII | re.IGNORECASE,
+)
+
+# 文件名中不合法字符到下划线的映射表
+_ILLEGAL_FILENAME_TRANS = str.maketrans({char: '_' for char in '/\\:*?"<>|'})
+
+# yt-dlp/ffmpeg下载和后处理过程中产生的临时文件（.part、.part-FragN、.ytdl、.temp.*、分离的音视频流.fNNN.*），
+# 这些文件很快会被重命名或删除，无需为其安排过期删除；下载失败遗留的临时文件由低频定时扫描清理
+_TEMP_FILE_PATTERN = re.compile(r'\.(?:part|ytdl|temp)$|\.part-Frag\d+|\.temp\.|\.f\d+\.\w+$')
+
+# 文件大小单位，下标为以1024为底的指数
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
+# 平台域名到平台名称的映射
+_PLATFORM_DOMAINS = {
+    "youtube.com": "YouTube",
+    "youtu.be": "YouTube",
+    "bilibili.com": "Bilibili",
+    "tiktok.com": "TikTok",
+    "twitter.com": "Twitter",
+    "x.com": "Twitter",
+    "facebook.com": "Facebook",
+    "fb.com": "Facebook",
+    "instagram.com": "Instagram",
+}
+_PLATFORM_PATTERN = re.compile(
+    "(" + "|".join(re.escape(domain) for domain in _PLATFORM_DOMAINS) + ")",
+    re.IGNORECASE,
+)
+
 def clean_old_files(directory: str, max_age_minutes: int = 30) -> List[str]:
     """
     清理指定目录中的旧文件
@@ -28,25 +71,27 @@ def clean_old_files(directory: str, max_age_minutes: int = 30) -> List[str]:
     max_age_seconds = max_age_minutes * 60
     
     try:
-        for filename in os.listdir(directory):
-            file_path = os.path.join(directory, filename)
-            if not os.path.isfile(file_path):
-                continue
-                
-            file_age = current_time - os.path.getmtime(file_path)
-            if file_age > max_age_seconds:
-                try:
-                    os.remove(file_path)
-                    deleted_files.append(filename)
-                    logger.info(f"删除过期文件: {filename} (已存在 {file_age/60:.1f} 分钟)")
-                except Exception as e:
-                    logger.error(f"删除文件 {filename} 失败: {str(e)}")
+        # scandir遍历目录时已带回文件类型，每个文件只需一次stat
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                    
+                file_age = current_time - entry.stat().st_mtime
+                if file_age > max_age_seconds:
+                    try:
+                        os.remove(entry.path)
+                        deleted_files.append(entry.name)
+                        logger.info(f"删除过期文件: {entry.name} (已存在 {file_age/60:.1f} 分钟)")
+                    except Exception as e:
+                        logger.error(f"删除文件 {entry.name} 失败: {str(e)}")
     except Exception as e:
         logger.error(f"清理旧文件时出错: {str(e)}")
     
     return deleted_files
 
-async def schedule_file_cleanup(directory: str, interval_minutes: int = 10, max_age_minutes: int = 30):
+async def schedule_file_cleanup(directory: str, interval_minutes: int = 10, max_age_minutes: int = 30,
+                                on_removed: Optional[Callable[[str], None]] = None):
     """
     定时清理旧文件的异步任务
     
@@ -54,6 +99,7 @@ async def schedule_file_cleanup(directory: str, interval_minutes: int = 10, max_
         directory: 要清理的目录路径
         interval_minutes: 检查间隔时间（分钟）
         max_age_minutes: 文件最大保留时间（分钟）
+        on_removed: 文件被删除后调用，参数为文件名
     """
     logger.info(f"启动定时清理任务: 每 {interval_minutes} 分钟检查一次，删除超过 {max_age_minutes} 分钟的文件")
     
@@ -65,19 +111,117 @@ async def schedule_file_cleanup(directory: str, interval_minutes: int = 10, max_
             # 执行清理
             now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             logger.info(f"[{now}] 开始执行定期清理...")
-            deleted = clean_old_files(directory, max_age_minutes)
+            # 逐个unlink是阻塞系统调用，放到工作线程中批量执行
+            deleted = await asyncio.to_thread(clean_old_files, directory, max_age_minutes)
             
             if deleted:
                 logger.info(f"已删除 {len(deleted)} 个过期文件: {', '.join(deleted)}")
+                if on_removed is not None:
+                    for filename in deleted:
+                        on_removed(filename)
             else:
                 logger.info("没有找到需要删除的过期文件")
                 
         except Exception as e:
             logger.error(f"执行定时清理任务时出错: {str(e)}")
 
+def remove_file_if_exists(file_path: str) -> None:
+    """
+    删除单个文件，文件已不存在时忽略
+    
+    Args:
+        file_path: 文件路径
+    """
+    try:
+        os.remove(file_path)
+        logger.info(f"删除过期文件: {os.path.basename(file_path)}")
+    except FileNotFoundError:
+        # 文件可能已被其他清理任务删除
+        pass
+    except Exception as e:
+        logger.error(f"删除文件 {file_path} 失败: {str(e)}")
+
+async def delete_file_later(file_path: str, delay_seconds: float) -> None:
+    """
+    等待指定时间后删除单个文件
+    
+    Args:
+        file_path: 文件路径
+        delay_seconds: 延迟时间（秒）
+    """
+    await asyncio.sleep(delay_seconds)
+    remove_file_if_exists(file_path)
+
+async def watch_file_cleanup(directory: str, max_age_minutes: int = 30,
+                             on_removed: Optional[Callable[[str], None]] = None,
+                             sweep_interval_minutes: int = 60):
+    """
+    基于inotify的文件过期清理任务（仅Linux），新文件写入完成时即安排到期删除；
+    另以低频定时扫描清理下载失败遗留的临时文件
+    
+    Args:
+        directory: 要清理的目录路径
+        max_age_minutes: 文件最大保留时间（分钟）
+        on_removed: 文件被删除后调用，参数为文件名
+        sweep_interval_minutes: 低频扫描的间隔时间（分钟）
+    """
+    loop = asyncio.get_running_loop()
+    max_age_seconds = max_age_minutes * 60
+    logger.info(f"启动inotify清理任务: 删除超过 {max_age_minutes} 分钟的文件")
+    
+    # 每个文件只保留一个删除定时器，重复事件时重新计时
+    timers: Dict[str, asyncio.TimerHandle] = {}
+    
+    def expire(path: str) -> None:
+        timers.pop(path, None)
+        remove_file_if_exists(path)
+        if on_removed is not None:
+            on_removed(os.path.basename(path))
+    
+    # 先为已存在的文件按剩余保留时间安排删除
+    now = time.time()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                remaining = max(entry.stat().st_mtime + max_age_seconds - now, 0)
+                timers[entry.path] = loop.call_later(remaining, expire, entry.path)
+    
+    # 临时文件不安排定时器，失败的下载遗留下来的由低频扫描清理
+    sweeper = asyncio.create_task(schedule_file_cleanup(
+        directory, interval_minutes=sweep_interval_minutes, max_age_minutes=max_age_minutes, on_removed=on_removed
+    ))
+    
+    # 监听新建（发布最终文件时的硬链接）、写入完成和移入的文件，跳过下载过程中的临时文件
+    try:
+        with Inotify() as inotify:
+            inotify.add_watch(directory, Mask.CREATE | Mask.CLOSE_WRITE | Mask.MOVED_TO)
+            async for event in inotify:
+                if event.path is None or event.mask & Mask.ISDIR or _TEMP_FILE_PATTERN.search(event.path.name):
+                    continue
+                path = str(event.path)
+                timer = timers.pop(path, None)
+                if timer is not None:
+                    timer.cancel()
+                timers[path] = loop.call_later(max_age_seconds, expire, path)
+    except OSError as e:
+        # 例如inotify监听数量达到上限，退回到定时扫描
+        logger.error(f"inotify监听失败，改用定时清理: {str(e)}")
+        sweeper.cancel()
+        await schedule_file_cleanup(directory, max_age_minutes=max_age_minutes, on_removed=on_removed)
+    finally:
+        sweeper.cancel()
+        for timer in timers.values():
+            timer.cancel()
+
+@functools.lru_cache(maxsize=None)
+def _ensured(path: str) -> bool:
+    # 创建失败时抛出异常，不会被缓存；成功后同一路径不再重复发起mkdir系统调用
+    os.makedirs(path, exist_ok=True)
+    return True
+
 def ensure_directory(directory: str) -> bool:
     """
-    确保目录存在，如果不存在则创建
+    确保目录存在，如果不存在则创建（已确认存在的目录会被缓存）
     
     Args:
         directory: 目录路径
@@ -86,8 +230,7 @@ def ensure_directory(directory: str) -> bool:
         操作是否成功
     """
     try:
-        os.makedirs(directory, exist_ok=True)
-        return True
+        return _ensured(os.path.abspath(directory))
     except Exception as e:
         logger.error(f"创建目录 {directory} 失败: {str(e)}")
         return False
@@ -105,17 +248,11 @@ def format_size(size_bytes: int) -> str:
     if size_bytes < 1024:
         return f"{size_bytes} B"
     
-    size_kb = size_bytes / 1024
-    if size_kb < 1024:
-        return f"{size_kb:.2f} KB"
-    
-    size_mb = size_kb / 1024
-    if size_mb < 1024:
-        return f"{size_mb:.2f} MB"
-    
-    size_gb = size_mb / 1024
-    return f"{size_gb:.2f} GB"
+    # 由二进制位数直接得到单位，每级1024即10位
+    unit = min((size_bytes.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (10 * unit)):.2f} {_SIZE_UNITS[unit]}"
 
+@functools.lru_cache(maxsize=4096)
 def sanitize_filename(filename: str) -> str:
     """
     清理文件名，移除不合法字符
@@ -126,10 +263,8 @@ def sanitize_filename(filename: str) -> str:
     Returns:
         清理后的文件名
     """
-    # 替换不合法的文件名字符
-    illegal_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-    for char in illegal_chars:
-        filename = filename.replace(char, '_')
+    # 替换不合法的文件名字符（一次遍历完成全部替换）
+    filename = filename.translate(_ILLEGAL_FILENAME_TRANS)
     
     # 限制文件名长度
     if len(filename) > 200:
@@ -138,6 +273,7 @@ def sanitize_filename(filename: str) -> str:
     
     return filename
 
+@functools.lru_cache(maxsize=4096)
 def detect_platform(url: str) -> str:
     """
     检测URL所属的平台
@@ -148,23 +284,25 @@ def detect_platform(url: str) -> str:
     Returns:
         平台名称，如YouTube, Bilibili等
     """
-    url = url.lower()
-    
-    if "youtube.com" in url or "youtu.be" in url:
-        return "YouTube"
-    elif "bilibili.com" in url:
-        return "Bilibili"
-    elif "tiktok.com" in url:
-        return "TikTok"
-    elif "twitter.com" in url or "x.com" in url:
-        return "Twitter"
-    elif "facebook.com" in url or "fb.com" in url:
-        return "Facebook"
-    elif "instagram.com" in url:
-        return "Instagram"
+    # 一次扫描匹配所有平台域名
+    match = _PLATFORM_PATTERN.search(url)
+    if match:
+        return _PLATFORM_DOMAINS[match.group(1).lower()]
     
     return "Unknown"
 
+def is_temp_file(filename: str) -> bool:
+    """
+    检查文件名是否为yt-dlp/ffmpeg下载或后处理过程中的临时文件
+    
+    Args:
+        filename: 文件名
+        
+    Returns:
+        是否为临时文件
+    """
+    return _TEMP_FILE_PATTERN.search(filename) is not None
+
 def is_safe_filename(filename: str) -> bool:
     """
     检查文件名是否安全（不含路径穿越尝试）
@@ -175,10 +313,4 @@ def is_safe_filename(filename: str) -> bool:
     Returns:
         是否为安全的文件名
     """
-    import re
-    # 不允许".."、"/"和"\"等路径操作符
-    if ".." in filename or "/" in filename or "\\" in filename:
-        return False
-    
-    # 只允许字母、数字、下划线、连字符和常见扩展名字符
-    return bool(re.match(r'^[a-zA-Z0-9_\-\.]+$', filename)) 
\ No newline at end of file
+    return _SAFE_FILENAME.fullmatch(filename) is not None